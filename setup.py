@@ -17,7 +17,7 @@ requirements = [
     'nibabel',
     'numpy',
     'scipy',
-    'torch>=1.1',
+    'torch>=1.5',
     'torchvision',
     'tqdm',
 ]
@@ -64,6 +64,7 @@ setup(
     },
     extras_require={
         'plot': ['matplotlib'],
+        'numba': ['numba'],
     },
     install_requires=requirements,
     license='MIT license',
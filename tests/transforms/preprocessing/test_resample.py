@@ -1,7 +1,13 @@
+import pickle
+import unittest
+import importlib.util
+from unittest import mock
+
 import torch
 import numpy as np
-from torchio import ScalarImage
+from torchio import ScalarImage, LabelMap, Subject
 from torchio.transforms import Resample
+from torchio.utils import sitk_to_nib
 from ...utils import TorchioTestCase
 
 
@@ -38,6 +44,50 @@ class TestResample(TorchioTestCase):
             else:
                 self.assertTensorEqual(image.affine, np.eye(4))
 
+    def test_rotation_pre_affine(self):
+        angle = 0.3
+        pre_affine = np.eye(4)
+        pre_affine[:2, :2] = (
+            (np.cos(angle), -np.sin(angle)),
+            (np.sin(angle), np.cos(angle)),
+        )
+        pre_affine[:3, 3] = 1.3, -2.1, 0.7
+        image = ScalarImage(
+            tensor=torch.rand(1, 10, 12, 14),
+            affine=np.diag((1.1, 0.9, 1.3, 1)),
+        )
+        image['pre_affine'] = pre_affine
+        reference_affine = np.diag((1.2, 1.05, 1.4, 1))
+        reference_affine[:3, 3] = 2, -1, 1
+        reference = ScalarImage(
+            tensor=torch.zeros(1, 9, 11, 13),
+            affine=reference_affine,
+        )
+        # Expected result: the pre-affine applied to the header
+        moved = ScalarImage(
+            tensor=image.data.clone(),
+            affine=pre_affine @ image.affine,
+        )
+        backends = ['sitk', 'torch']
+        if importlib.util.find_spec('numba'):
+            backends.append('numba')
+        for backend in backends:
+            for target in ((1.5, 0.8, 1.2), reference):
+                transformed = Resample(
+                    target,
+                    pre_affine_name='pre_affine',
+                    backend=backend,
+                )(Subject(image=image)).image
+                expected = Resample(
+                    target,
+                    backend=backend,
+                )(Subject(image=moved)).image
+                self.assertEqual(transformed.shape, expected.shape)
+                self.assertTensorAlmostEqual(
+                    transformed.affine, expected.affine)
+                self.assertTensorAlmostEqual(
+                    transformed.data, expected.data, decimal=5)
+
     def test_missing_affine(self):
         transform = Resample(1, pre_affine_name='missing')
         with self.assertRaises(ValueError):
@@ -73,3 +123,169 @@ class TestResample(TorchioTestCase):
         transform = Resample(0.5)
         shape = transform(image).shape
         self.assertEqual(shape, (1, 4, 6, 1))
+
+    def test_pickle_after_call(self):
+        reference_image, _ = self.get_reference_image_and_path()
+        transform = Resample(reference_image)
+        transform(self.sample_subject)
+        unpickled = pickle.loads(pickle.dumps(transform))
+        transformed = unpickled(self.sample_subject)
+        for image in transformed.values():
+            self.assertEqual(reference_image.shape, image.shape)
+
+    def test_torch_backend(self):
+        subject = self.get_inconsistent_shape_subject()
+        for target in (0.7, (2, 1.5, 3), 't1'):
+            transformed_sitk = Resample(target)(subject)
+            transformed_torch = Resample(target, backend='torch')(subject)
+            for name in ('t1', 't2'):
+                image_sitk = transformed_sitk[name]
+                image_torch = transformed_torch[name]
+                self.assertEqual(image_sitk.shape, image_torch.shape)
+                self.assertTensorAlmostEqual(
+                    image_sitk.affine, image_torch.affine)
+                self.assertTensorAlmostEqual(
+                    image_sitk.data, image_torch.data, decimal=4)
+
+    def test_torch_backend_shared_grid(self):
+        affine = np.diag((1.1, 0.9, 1.3, 1))
+        subject = Subject(
+            multichannel=ScalarImage(
+                tensor=torch.rand(3, 10, 12, 14), affine=affine),
+            scalar=ScalarImage(
+                tensor=torch.rand(1, 10, 12, 14), affine=affine),
+            label=LabelMap(
+                tensor=torch.randint(0, 5, (1, 10, 12, 14)), affine=affine),
+        )
+        reference_affine = np.diag((1.2, 1.05, 1.4, 1))
+        reference_affine[:3, 3] = 0.3, -0.2, 0.1
+        reference = ScalarImage(
+            tensor=torch.zeros(1, 9, 11, 13),
+            affine=reference_affine,
+        )
+        for target in ((1.5, 0.7, 1.9), reference):
+            transformed_sitk = Resample(target)(subject)
+            transformed_torch = Resample(target, backend='torch')(subject)
+            for name in ('multichannel', 'scalar', 'label'):
+                image_sitk = transformed_sitk[name]
+                image_torch = transformed_torch[name]
+                self.assertEqual(image_sitk.shape, image_torch.shape)
+                self.assertTensorAlmostEqual(
+                    image_sitk.affine, image_torch.affine)
+                self.assertTensorAlmostEqual(
+                    image_sitk.data, image_torch.data, decimal=5)
+            reference_affine = reference.affine.copy()
+            transformed_torch.scalar.affine[:3, 3] += 5
+            for name in ('multichannel', 'label'):
+                self.assertTensorAlmostEqual(
+                    transformed_torch[name].affine,
+                    transformed_sitk[name].affine,
+                )
+            self.assertTensorEqual(reference.affine, reference_affine)
+
+    def test_get_reference_image(self):
+        affine = np.diag((1.1, 0.9, 1.3, 1))
+        affine[:3, 3] = 3, -4, 7
+        image = ScalarImage(tensor=torch.rand(1, 10, 7, 5), affine=affine)
+        spacing = 0.7, 1.9, 1.1
+        reference = Resample.get_reference_image(image.as_sitk(), spacing)
+        transformed = Resample(spacing, image_interpolation='bspline')(image)
+        self.assertEqual(reference.GetSize(), transformed.spatial_shape)
+        self.assertTensorAlmostEqual(reference.GetSpacing(), spacing)
+        _, reference_affine = sitk_to_nib(reference)
+        self.assertTensorAlmostEqual(reference_affine, transformed.affine)
+
+    def test_auto_backend_in_worker(self):
+        transform = Resample(1, backend='auto')
+        module = 'torchio.transforms.preprocessing.spatial.resample'
+        with mock.patch('torch.cuda.is_available', return_value=True):
+            self.assertTrue(transform.use_torch('linear'))
+            with mock.patch(f'{module}.get_worker_info', return_value=1):
+                self.assertFalse(transform.use_torch('linear'))
+
+    def test_reference_affine_not_shared(self):
+        reference_image, _ = self.get_reference_image_and_path()
+        backends = ['sitk', 'torch']
+        if importlib.util.find_spec('numba'):
+            backends.append('numba')
+        for backend in backends:
+            transform = Resample(reference_image, backend=backend)
+            transformed = transform(self.sample_subject)
+            self.assertIsNot(transformed.t1.affine, reference_image.affine)
+
+    @unittest.skipUnless(torch.cuda.is_available(), 'CUDA is not available')
+    def test_half_precision(self):
+        image = ScalarImage(tensor=torch.rand(1, 64, 64, 64))
+        reference_affine = np.diag((1.2, 0.9, 1.05, 1))
+        reference_affine[:3, 3] = 0.3, -0.2, 0.1
+        reference = ScalarImage(
+            tensor=torch.zeros(1, 50, 70, 60),
+            affine=reference_affine,
+        )
+        transformed_single = Resample(reference, backend='torch')(image)
+        transformed_half = Resample(
+            reference,
+            backend='torch',
+            half_precision=True,
+        )(image)
+        difference = transformed_half.data - transformed_single.data
+        self.assertLess(difference.abs().max(), 0.03)
+
+    def test_wrong_backend(self):
+        with self.assertRaises(ValueError):
+            Resample(1, backend='scipy')
+
+    @unittest.skipUnless(
+        importlib.util.find_spec('numba'),
+        'Numba is not installed',
+    )
+    def test_numba_backend(self):
+        subject = self.get_inconsistent_shape_subject()
+        for target in (0.7, (2, 1.5, 3), 't1'):
+            transformed_sitk = Resample(target)(subject)
+            transformed_numba = Resample(target, backend='numba')(subject)
+            for image_sitk, image_numba in zip(
+                    transformed_sitk.get_images(intensity_only=False),
+                    transformed_numba.get_images(intensity_only=False),
+                    ):
+                self.assertEqual(image_sitk.shape, image_numba.shape)
+                self.assertTensorAlmostEqual(
+                    image_sitk.affine, image_numba.affine)
+                self.assertTensorAlmostEqual(
+                    image_sitk.data, image_numba.data, decimal=4)
+
+    def test_scaling_same_as_reference(self):
+        image = ScalarImage(tensor=torch.rand(2, 10, 20, 30))
+        for spacing in (0.5, (2, 1, 0.5), (1, 1, 1)):
+            transformed = Resample(spacing)(image)
+            reference = ScalarImage(
+                tensor=torch.zeros(transformed.shape),
+                affine=transformed.affine,
+            )
+            expected = Resample(reference)(image)
+            self.assertTensorAlmostEqual(
+                transformed.data, expected.data, decimal=5)
+
+    def test_spacing_list(self):
+        transform = Resample([1, 2, 3])
+        self.assertEqual(transform.target_spacing, (1, 2, 3))
+        for value in transform.target_spacing:
+            self.assertIsInstance(value, float)
+
+    def test_wrong_spacing_sign(self):
+        with self.assertRaises(ValueError):
+            Resample((1, -1, 1))
+
+    def test_apply_to_dataset(self):
+        transform = Resample(2)
+        subjects = [self.sample_subject, self.sample_subject]
+        for num_workers in (0, 2):
+            all_paths = transform.apply_to_dataset(
+                subjects, self.dir, num_workers=num_workers)
+            self.assertEqual(len(all_paths), 2)
+            expected = transform(self.sample_subject)
+            for name, path in all_paths[1].items():
+                image = type(expected[name])(path)
+                self.assertTensorAlmostEqual(image.data, expected[name].data)
+                self.assertTensorAlmostEqual(
+                    image.affine, expected[name].affine)
@@ -0,0 +1,69 @@
+import numpy as np
+from numba import njit, prange
+
+
+@njit(parallel=True, fastmath=True, boundscheck=False, cache=True)
+def trilinear_resample(src, matrix, out_shape):
+    """Resample a 4D array using trilinear interpolation.
+
+    Args:
+        src: Array with dimensions :math:`(C, W, H, D)`.
+        matrix: :math:`4 \\times 4` matrix mapping voxel indices of the output
+            to voxel indices of the input.
+        out_shape: Spatial shape of the output.
+
+    As in ITK, points outside the field of view of the input are set to zero
+    and the border values are used for points between the centers of the
+    border voxels and the edges of the field of view.
+
+    The innermost loop runs along the last, contiguous, axis of the output
+    and has no branches, so that it can be vectorized by LLVM. Indices are
+    always clamped and points outside the field of view are masked out
+    instead of skipped.
+    """
+    num_channels, si, sj, sk = src.shape
+    oi, oj, ok = out_shape
+    out = np.empty((num_channels, oi, oj, ok), dtype=src.dtype)
+    for i in prange(oi):
+        for j in range(oj):
+            # Input coordinates of the first voxel in this row of the output
+            x_row = matrix[0, 0] * i + matrix[0, 1] * j + matrix[0, 3]
+            y_row = matrix[1, 0] * i + matrix[1, 1] * j + matrix[1, 3]
+            z_row = matrix[2, 0] * i + matrix[2, 1] * j + matrix[2, 3]
+            for c in range(num_channels):
+                for k in range(ok):
+                    x = x_row + matrix[0, 2] * k
+                    y = y_row + matrix[1, 2] * k
+                    z = z_row + matrix[2, 2] * k
+                    inside = (
+                        (x >= -0.5) & (x < si - 0.5)
+                        & (y >= -0.5) & (y < sj - 0.5)
+                        & (z >= -0.5) & (z < sk - 0.5)
+                    )
+                    x_floor = np.floor(x)
+                    y_floor = np.floor(y)
+                    z_floor = np.floor(z)
+                    fx = x - x_floor
+                    fy = y - y_floor
+                    fz = z - z_floor
+                    x0 = min(max(int(x_floor), 0), si - 1)
+                    y0 = min(max(int(y_floor), 0), sj - 1)
+                    z0 = min(max(int(z_floor), 0), sk - 1)
+                    x1 = min(max(int(x_floor) + 1, 0), si - 1)
+                    y1 = min(max(int(y_floor) + 1, 0), sj - 1)
+                    z1 = min(max(int(z_floor) + 1, 0), sk - 1)
+                    gx = 1 - fx
+                    gy = 1 - fy
+                    gz = 1 - fz
+                    value = (
+                        src[c, x0, y0, z0] * gx * gy * gz
+                        + src[c, x1, y0, z0] * fx * gy * gz
+                        + src[c, x0, y1, z0] * gx * fy * gz
+                        + src[c, x1, y1, z0] * fx * fy * gz
+                        + src[c, x0, y0, z1] * gx * gy * fz
+                        + src[c, x1, y0, z1] * fx * gy * fz
+                        + src[c, x0, y1, z1] * gx * fy * fz
+                        + src[c, x1, y1, z1] * fx * fy * fz
+                    )
+                    out[c, i, j, k] = value * inside
+    return out
@@ -1,18 +1,35 @@
+import math
+import importlib.util
 from pathlib import Path
 from numbers import Number
-from typing import Union, Tuple, Optional, Sequence
+from concurrent.futures import ProcessPoolExecutor
+from typing import Union, Tuple, Optional, Sequence, List, Dict
 
 import torch
 import numpy as np
+import torch.nn.functional as F
 import SimpleITK as sitk
+from torch.utils.data import get_worker_info
 
 from ....data.subject import Subject
 from ....data.image import Image, ScalarImage
-from ....torchio import DATA, AFFINE, TypeTripletFloat
-from ....utils import sitk_to_nib
+from ....torchio import (
+    DATA,
+    AFFINE,
+    TypePath,
+    TypeTripletFloat,
+    TypeTripletInt,
+)
+from ....utils import (
+    get_rotation_and_spacing_from_affine,
+    FLIP_XY,
+)
 from ... import SpatialTransform
 
 
+BACKENDS = 'sitk', 'torch', 'numba', 'auto'
+TORCH_MODES = {'nearest': 'nearest', 'linear': 'bilinear'}
+FWHM_TO_VARIANCE = (2 * math.sqrt(2 * math.log(2))) ** -2
 TypeSpacing = Union[float, Tuple[float, float, float]]
 TypeTarget = Tuple[
     Optional[Union[Image, str]],
@@ -38,6 +55,40 @@ class Resample(SpatialTransform):
             Supported interpolation techniques for resampling
             are ``'nearest'``, ``'linear'`` and ``'bspline'``.
         scalars_only: Apply only to instances of :class:`torchio.ScalarImage`.
+        backend: Library used to resample the images. If ``'sitk'``,
+            :mod:`SimpleITK` is used. If ``'torch'``, images are resampled
+            with :func:`torch.nn.functional.grid_sample`, on the GPU if
+            available. If ``'numba'``, linear interpolation is computed with
+            a parallel kernel compiled with :mod:`numba`, which must be
+            installed. If ``'auto'``, the PyTorch backend is used if a GPU is
+            available and the transform is not running in a
+            :class:`~torch.utils.data.DataLoader` worker, otherwise the Numba
+            backend is used for linear interpolation if :mod:`numba` is
+            installed. Interpolations not
+            supported by a backend use :mod:`SimpleITK`. Nearest neighbor
+            interpolation might break ties differently in different
+            backends. For all backends, if the target is a spacing and it
+            does not change the grid, only the affine is updated. If the new
+            grid is a scaled version of the old one, linear interpolation is
+            computed with :func:`torch.nn.functional.interpolate` on the CPU,
+            which samples the same points as :mod:`SimpleITK`.
+
+            .. warning:: CUDA cannot be used in subprocesses created with
+                ``fork``, which is the default start method of the workers
+                of a :class:`~torch.utils.data.DataLoader` on Linux. If a GPU
+                is available, use ``'torch'`` only in the main process or
+                with workers started with ``'spawn'``.
+        half_precision: If ``True`` and the PyTorch backend is used on a GPU,
+            linear interpolation is computed using 16-bit floating point
+            values to reduce memory traffic. The intensities must be within
+            the range of :attr:`torch.float16` and results will be less
+            accurate, especially for large images: the sampling positions
+            along an axis of :math:`N` voxels can be off by up to
+            :math:`N / 8192` voxels (about 0.03 voxels for 256 voxels) and
+            intensities are rounded with a relative error of about
+            :math:`10^{-3}`. For intensities in :math:`[0, 1]` and images of
+            :math:`64^3` voxels, differences with single precision are
+            below 0.03.
         p: Probability that this transform will be applied.
         keys: See :class:`~torchio.transforms.Transform`.
 
@@ -58,6 +109,8 @@ class Resample(SpatialTransform):
             image_interpolation: str = 'linear',
             pre_affine_name: Optional[str] = None,
             scalars_only: bool = False,
+            backend: str = 'sitk',
+            half_precision: bool = False,
             p: float = 1,
             keys: Optional[Sequence[str]] = None,
             ):
@@ -67,13 +120,27 @@ class Resample(SpatialTransform):
         self.image_interpolation = self.parse_interpolation(image_interpolation)
         self.pre_affine_name = pre_affine_name
         self.scalars_only = scalars_only
+        self.backend = self.parse_backend(backend)
+        self.half_precision = half_precision
+        self._ref_cache = {}
+        self._resampler = None
         self.args_names = (
             'target',
             'image_interpolation',
             'pre_affine_name',
             'scalars_only',
+            'backend',
+            'half_precision',
         )
 
+    def __getstate__(self):
+        # Cached SimpleITK objects might not be picklable, e.g. when the
+        # transform is sent to DataLoader workers
+        state = self.__dict__.copy()
+        state['_ref_cache'] = {}
+        state['_resampler'] = None
+        return state
+
     def parse_target(
             self,
             target: Union[TypeSpacing, str],
@@ -100,20 +167,44 @@ class Resample(SpatialTransform):
 
     @staticmethod
     def parse_spacing(spacing: TypeSpacing) -> Tuple[float, float, float]:
-        if isinstance(spacing, tuple) and len(spacing) == 3:
-            result = spacing
-        elif isinstance(spacing, Number):
-            result = 3 * (spacing,)
+        if isinstance(spacing, Number):
+            result = 3 * (float(spacing),)
+        elif hasattr(spacing, '__len__') and len(spacing) == 3:
+            result = tuple(float(s) for s in spacing)
         else:
             message = (
                 'Target must be a string, a positive number'
-                f' or a tuple of positive numbers, not {type(spacing)}'
+                f' or a sequence of 3 positive numbers, not {type(spacing)}'
             )
             raise ValueError(message)
-        if np.any(np.array(spacing) <= 0):
+        if any(s <= 0 for s in result):
             raise ValueError(f'Spacing must be positive, not "{spacing}"')
         return result
 
+    @staticmethod
+    def parse_backend(backend: str) -> str:
+        if backend not in BACKENDS:
+            message = (
+                f'Backend must be one of {BACKENDS}, not "{backend}"'
+            )
+            raise ValueError(message)
+        return backend
+
+    def use_torch(self, interpolation: str) -> bool:
+        if interpolation not in TORCH_MODES:
+            return False
+        if self.backend == 'auto':
+            return _can_use_cuda()
+        return self.backend == 'torch'
+
+    def use_numba(self, interpolation: str) -> bool:
+        if interpolation != 'linear':
+            return False
+        if self.backend == 'auto':
+            has_numba = importlib.util.find_spec('numba') is not None
+            return has_numba and not _can_use_cuda()
+        return self.backend == 'numba'
+
     @staticmethod
     def check_affine(affine_name: str, image_dict: dict):
         if not isinstance(affine_name, str):
@@ -137,22 +228,21 @@ class Resample(SpatialTransform):
                 )
                 raise ValueError(message)
 
-    @staticmethod
-    def check_affine_key_presence(affine_name: str, subject: Subject):
-        for image_dict in subject.get_images(intensity_only=False):
-            if affine_name in image_dict:
-                return
-        message = (
-            f'An affine name was given ("{affine_name}"), but it was not found'
-            ' in any image in the subject'
-        )
-        raise ValueError(message)
-
     def apply_transform(self, subject: Subject) -> Subject:
-        use_pre_affine = self.pre_affine_name is not None
-        if use_pre_affine:
-            self.check_affine_key_presence(self.pre_affine_name, subject)
-        for image in self.get_images(subject):
+        images = self.get_images(subject)
+        if self.pre_affine_name is None:
+            pre_affines = {}
+        else:
+            pre_affines = self.compose_pre_affines(images)
+        # The reference is shared by all the images, unless the target is a
+        # spacing. In that case, it depends on each image
+        if isinstance(self.reference_image, str):
+            reference = self.get_reference_from_subject(subject)
+        else:
+            reference = self.reference_image
+        reference_image_sitk = None
+        torch_groups = {}
+        for image in images:
             # Do not resample the reference image if there is one
             if image is self.reference_image:
                 continue
@@ -167,70 +257,272 @@ class Resample(SpatialTransform):
             interpolator = self.get_sitk_interpolator(interpolation)
 
             # Apply given affine matrix if found in image
-            if use_pre_affine and self.pre_affine_name in image:
-                self.check_affine(self.pre_affine_name, image)
-                matrix = image[self.pre_affine_name]
-                if isinstance(matrix, torch.Tensor):
-                    matrix = matrix.numpy()
-                image[AFFINE] = matrix @ image[AFFINE]
+            if id(image) in pre_affines:
+                pre_affine, floating_affine = pre_affines[id(image)]
+            else:
+                pre_affine, floating_affine = None, image[AFFINE]
+
+            if reference is None:  # target is a spacing
+                resampled = self.resample_scaling(
+                    image, floating_affine, interpolation)
+                if resampled:
+                    continue
+
+            if self.use_torch(interpolation):
+                # Images with the same grid are resampled together
+                key = floating_affine.tobytes(), image.spatial_shape
+                _, group = torch_groups.setdefault(key, (floating_affine, []))
+                group.append((image, interpolation))
+                continue
+            if self.use_numba(interpolation):
+                self.resample_numba(image, floating_affine, reference)
+                continue
 
             floating_itk = image.as_sitk(force_3d=True)
 
             # Resample
             if isinstance(self.reference_image, str):
-                try:
-                    reference_image_sitk = subject[self.reference_image].as_sitk()
-                except KeyError as error:
-                    message = (
-                        f'Reference name "{self.reference_image}"'
-                        ' not found in subject'
-                    )
-                    raise ValueError(message) from error
+                if reference_image_sitk is None:
+                    reference_image_sitk = reference.as_sitk(force_3d=True)
             elif isinstance(self.reference_image, Image):
-                reference_image_sitk = self.reference_image.as_sitk(
-                    force_3d=True)
-            elif self.reference_image is None:  # target is a spacing
-                reference_image_sitk = self.get_reference_image(
-                    floating_itk,
-                    self.target_spacing,
-                )
-
-            num_dims_ref = reference_image_sitk.GetDimension()
-            num_dims_flo = floating_itk.GetDimension()
-            assert num_dims_ref == num_dims_flo
+                key = id(self.reference_image)
+                if key not in self._ref_cache:
+                    self._ref_cache[key] = self.reference_image.as_sitk(
+                        force_3d=True)
+                reference_image_sitk = self._ref_cache[key]
 
-            resampler = sitk.ResampleImageFilter()
+            resampler = self.get_resampler()
             resampler.SetInterpolator(interpolator)
-            resampler.SetReferenceImage(reference_image_sitk)
+            if self.reference_image is None:  # target is a spacing
+                # Use the header after applying the pre-affine, if any
+                reference_affine, size = _get_reference_affine_and_shape(
+                    floating_affine,
+                    image.spatial_shape,
+                    self.target_spacing,
+                )
+                spacing, direction, origin = _get_sitk_geometry(
+                    reference_affine)
+                resampler.SetSize(size)
+                resampler.SetOutputSpacing(spacing)
+                resampler.SetOutputOrigin(origin)
+                resampler.SetOutputDirection(direction)
+            else:
+                resampler.SetReferenceImage(reference_image_sitk)
+            if pre_affine is not None:
+                resampler.SetTransform(_get_sitk_transform(pre_affine))
             resampled = resampler.Execute(floating_itk)
 
-            array, affine = sitk_to_nib(resampled)
+            # The transposed array is a view, so the data is copied only once
+            array = sitk.GetArrayFromImage(resampled).transpose()
+            if resampled.GetNumberOfComponentsPerPixel() == 1:
+                array = array[np.newaxis]
             image[DATA] = torch.from_numpy(array)
-            image[AFFINE] = affine
+            image[AFFINE] = _get_affine_from_sitk(resampled)
+
+        for affine, group in torch_groups.values():
+            self.resample_torch(group, affine, reference)
         return subject
 
+    def compose_pre_affines(
+            self,
+            images: List[Image],
+            ) -> Dict[int, Tuple[np.ndarray, np.ndarray]]:
+        """Return the pre-affine matrix of each image that contains one and
+        its composition with the image affine, indexed by image ID."""
+        images = [image for image in images if self.pre_affine_name in image]
+        if not images:
+            message = (
+                f'An affine name was given ("{self.pre_affine_name}"), but it'
+                ' was not found in any image in the subject'
+            )
+            raise ValueError(message)
+        matrices = []
+        for image in images:
+            self.check_affine(self.pre_affine_name, image)
+            matrix = image[self.pre_affine_name]
+            if isinstance(matrix, torch.Tensor):
+                matrix = matrix.numpy()
+            matrices.append(matrix)
+        matrices = np.stack(matrices)
+        affines = np.stack([image[AFFINE] for image in images])
+        composed = np.matmul(matrices, affines)
+        items = zip(images, matrices, composed)
+        return {id(image): (m, c) for image, m, c in items}
+
+    def get_resampler(self) -> sitk.ResampleImageFilter:
+        if self._resampler is None:
+            self._resampler = sitk.ResampleImageFilter()
+        # DataLoader workers already run in parallel, so using more than one
+        # thread per worker would oversubscribe the CPU
+        if get_worker_info() is None:
+            num_threads = sitk.ProcessObject.GetGlobalDefaultNumberOfThreads()
+        else:
+            num_threads = 1
+        self._resampler.SetNumberOfThreads(num_threads)
+        self._resampler.SetTransform(sitk.Transform())
+        return self._resampler
+
+    def get_reference_from_subject(self, subject: Subject) -> Image:
+        try:
+            return subject[self.reference_image]
+        except KeyError as error:
+            message = (
+                f'Reference name "{self.reference_image}"'
+                ' not found in subject'
+            )
+            raise ValueError(message) from error
+
+    def get_target_geometry(
+            self,
+            image: Image,
+            affine: np.ndarray,
+            reference: Optional[Image],
+            ) -> Tuple[np.ndarray, TypeTripletInt]:
+        if reference is None:  # target is a spacing
+            return _get_reference_affine_and_shape(
+                affine,
+                image.spatial_shape,
+                self.target_spacing,
+            )
+        return reference[AFFINE].copy(), reference.spatial_shape
+
+    def resample_scaling(
+            self,
+            image: Image,
+            affine: np.ndarray,
+            interpolation: str,
+            ) -> bool:
+        """Resample without interpolating if the spacing does not change, or
+        with :func:`torch.nn.functional.interpolate` if the new grid is a
+        scaled version of the old one.
+
+        Return ``False`` if the image could not be resampled this way.
+        """
+        shape = image.spatial_shape
+        dst_affine, dst_shape = _get_reference_affine_and_shape(
+            affine,
+            shape,
+            self.target_spacing,
+        )
+        if dst_shape == shape and np.allclose(dst_affine, affine):
+            image[AFFINE] = dst_affine
+            return True
+        if interpolation != 'linear':
+            return False
+        _, old_spacing = get_rotation_and_spacing_from_affine(affine)
+        scale_factors = []
+        for n, new_n, old, new in zip(
+                shape, dst_shape, old_spacing, self.target_spacing):
+            scale = old / new
+            if n == 1:
+                # ITK samples outside the field of view for large spacings
+                if scale <= 0.5:
+                    return False
+                scale = 1
+            # interpolate() uses the floor instead of the ceiling
+            elif math.floor(n * scale) != new_n:
+                return False
+            scale_factors.append(scale)
+        # The sampling positions are the same as in ITK
+        resampled = F.interpolate(
+            image[DATA][np.newaxis],
+            scale_factor=scale_factors,
+            mode='trilinear',
+            align_corners=False,
+            recompute_scale_factor=False,
+        )
+        image[DATA] = resampled[0]
+        image[AFFINE] = dst_affine
+        return True
+
+    def resample_torch(
+            self,
+            images: List[Tuple[Image, str]],
+            affine: np.ndarray,
+            reference: Optional[Image],
+            ) -> None:
+        """Resample images that share the same grid.
+
+        The sampling grid is computed once and the images are stacked along
+        the channels dimension, so only one call to ``grid_sample`` is needed
+        per interpolation mode.
+        """
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        first_image = images[0][0]
+        dst_affine, dst_shape = self.get_target_geometry(
+            first_image, affine, reference)
+        grid, inside = _get_sampling_grid(
+            affine,
+            first_image.spatial_shape,
+            dst_affine,
+            dst_shape,
+            device,
+        )
+        for interpolation, mode in TORCH_MODES.items():
+            group = [image for image, i in images if i == interpolation]
+            if not group:
+                continue
+            data = torch.cat([image[DATA] for image in group]).to(device)
+            use_half = (
+                self.half_precision
+                and interpolation == 'linear'
+                and data.is_cuda
+            )
+            if use_half:
+                resampled = _resample_torch(
+                    data.half(),
+                    grid.half(),
+                    inside,
+                    mode,
+                ).float()
+            else:
+                resampled = _resample_torch(data, grid, inside, mode)
+            resampled = resampled.cpu()
+            num_channels = [len(image[DATA]) for image in group]
+            for image, tensor in zip(group, resampled.split(num_channels)):
+                image[DATA] = tensor
+                image[AFFINE] = dst_affine.copy()
+
+    def resample_numba(
+            self,
+            image: Image,
+            affine: np.ndarray,
+            reference: Optional[Image],
+            ) -> None:
+        trilinear_resample = import_trilinear_resample()
+        dst_affine, dst_shape = self.get_target_geometry(
+            image, affine, reference)
+        # Voxel indices in the target to voxel indices in the source
+        voxel_to_voxel = np.linalg.inv(affine) @ dst_affine
+        array = trilinear_resample(
+            np.ascontiguousarray(image.numpy()),
+            voxel_to_voxel,
+            tuple(dst_shape),
+        )
+        image[DATA] = torch.from_numpy(array)
+        image[AFFINE] = dst_affine
+
     @staticmethod
     def get_reference_image(
             image: sitk.Image,
             spacing: TypeTripletFloat,
             ) -> sitk.Image:
-        old_spacing = np.array(image.GetSpacing())
-        new_spacing = np.array(spacing)
-        old_size = np.array(image.GetSize())
-        new_size = old_size * old_spacing / new_spacing
-        new_size = np.ceil(new_size).astype(np.uint16)
-        new_size[old_size == 1] = 1  # keep singleton dimensions
-        new_origin_index = 0.5 * (new_spacing / old_spacing - 1)
-        new_origin_lps = image.TransformContinuousIndexToPhysicalPoint(
-            new_origin_index)
+        """Return a 3D image with the field of view of the input image and
+        the given spacing."""
+        affine, size = _get_reference_affine_and_shape(
+            _get_affine_from_sitk(image),
+            image.GetSize(),
+            spacing,
+        )
+        spacing, direction, origin = _get_sitk_geometry(affine)
         reference = sitk.Image(
-            new_size.tolist(),
+            size,
             image.GetPixelID(),
             image.GetNumberOfComponentsPerPixel(),
         )
-        reference.SetDirection(image.GetDirection())
-        reference.SetSpacing(new_spacing.tolist())
-        reference.SetOrigin(new_origin_lps)
+        reference.SetDirection(direction)
+        reference.SetSpacing(spacing)
+        reference.SetOrigin(origin)
         return reference
 
     @staticmethod
@@ -241,6 +533,215 @@ class Resample(SpatialTransform):
         beyond aliasing in image resampling", MICCAI 2015
         """
         k = downsampling_factor
-        variance = (k ** 2 - 1 ** 2) * (2 * np.sqrt(2 * np.log(2))) ** (-2)
-        sigma = spacing * np.sqrt(variance)
+        variance = (k * k - 1) * FWHM_TO_VARIANCE
+        if isinstance(variance, Number):
+            sigma = spacing * math.sqrt(variance)
+        else:
+            sigma = spacing * np.sqrt(variance)
         return sigma
+
+    def apply_to_dataset(
+            self,
+            subjects: Sequence[Subject],
+            out_dir: TypePath,
+            num_workers: int = 0,
+            ) -> List[Dict[str, Path]]:
+        """Resample subjects and write the resampled images to disk.
+
+        Subjects are processed in parallel in separate processes. The
+        transform is sent to each process only once.
+
+        Args:
+            subjects: Sequence of instances of :class:`torchio.Subject`.
+            out_dir: Directory in which the images will be written. Images
+                are saved as :file:`<out_dir>/<index>_<image_name>.nii.gz`,
+                where ``<index>`` is the position of the subject in
+                :attr:`subjects`.
+            num_workers: Number of processes used to resample the subjects.
+                If ``0``, subjects are resampled in the main process.
+
+        Returns:
+            A list with one dictionary per subject, mapping the image names
+            to the paths of the saved images.
+
+        Example:
+            >>> import torchio as tio
+            >>> subjects = [tio.datasets.Colin27(), tio.datasets.FPG()]
+            >>> transform = tio.Resample(2)
+            >>> paths = transform.apply_to_dataset(subjects, 'out', 2)
+        """
+        out_dir = Path(out_dir)
+        out_dir.mkdir(parents=True, exist_ok=True)
+        jobs = [(i, subject, out_dir) for i, subject in enumerate(subjects)]
+        if num_workers == 0:
+            return [_resample_and_save(self, *job) for job in jobs]
+        with ProcessPoolExecutor(
+                max_workers=num_workers,
+                initializer=_init_worker,
+                initargs=(self,),
+                ) as executor:
+            results = executor.map(_resample_and_save_in_worker, *zip(*jobs))
+            return list(results)
+
+
+def import_trilinear_resample():
+    try:
+        from ._resample_numba import trilinear_resample
+    except ImportError as e:
+        raise ImportError('Install numba to use the numba backend') from e
+    return trilinear_resample
+
+
+def _can_use_cuda() -> bool:
+    # CUDA cannot be initialized in forked DataLoader workers
+    return torch.cuda.is_available() and get_worker_info() is None
+
+
+_worker_transform = None
+
+
+def _init_worker(transform: Resample) -> None:
+    # Subjects are already resampled in parallel, so each worker uses one
+    # thread to avoid oversubscribing the CPU
+    global _worker_transform
+    sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(1)
+    torch.set_num_threads(1)
+    transform.get_resampler()
+    _worker_transform = transform
+
+
+def _resample_and_save_in_worker(
+        index: int,
+        subject: Subject,
+        out_dir: Path,
+        ) -> Dict[str, Path]:
+    return _resample_and_save(_worker_transform, index, subject, out_dir)
+
+
+def _resample_and_save(
+        transform: Resample,
+        index: int,
+        subject: Subject,
+        out_dir: Path,
+        ) -> Dict[str, Path]:
+    transformed = transform(subject)
+    paths = {}
+    images = transformed.get_images_dict(intensity_only=False)
+    for name, image in images.items():
+        path = out_dir / f'{index}_{name}.nii.gz'
+        image.save(path)
+        paths[name] = path
+    return paths
+
+
+def _get_sitk_geometry(
+        affine: np.ndarray,
+        ) -> Tuple[Tuple[float, ...], Tuple[float, ...], Tuple[float, ...]]:
+    """Return the spacing, direction and origin used by SimpleITK."""
+    rotation, spacing = get_rotation_and_spacing_from_affine(affine)
+    direction = FLIP_XY @ rotation
+    origin = FLIP_XY @ affine[:3, 3]
+    return tuple(spacing), tuple(direction.flatten()), tuple(origin)
+
+
+def _get_affine_from_sitk(image: sitk.Image) -> np.ndarray:
+    """Inverse of :func:`_get_sitk_geometry` for 3D images."""
+    spacing = np.array(image.GetSpacing())
+    rotation = np.array(image.GetDirection()).reshape(3, 3)
+    affine = np.eye(4)
+    affine[:3, :3] = FLIP_XY @ rotation * spacing
+    affine[:3, 3] = FLIP_XY @ image.GetOrigin()
+    return affine
+
+
+def _get_sitk_transform(affine: np.ndarray) -> sitk.AffineTransform:
+    """Return the transform used to resample after applying an affine.
+
+    SimpleITK transforms map points of the output image to points of the
+    input image, in LPS coordinates.
+    """
+    flip = np.diag((-1, -1, 1, 1))
+    matrix = flip @ np.linalg.inv(affine) @ flip
+    transform = sitk.AffineTransform(3)
+    transform.SetMatrix(matrix[:3, :3].flatten().tolist())
+    transform.SetTranslation(matrix[:3, 3].tolist())
+    return transform
+
+
+def _get_reference_affine_and_shape(
+        affine: np.ndarray,
+        shape: TypeTripletInt,
+        spacing: TypeTripletFloat,
+        ) -> Tuple[np.ndarray, TypeTripletInt]:
+    """Return the affine and shape of a grid with the field of view of the
+    given one and the given spacing."""
+    rotation, old_spacing = get_rotation_and_spacing_from_affine(affine)
+    new_shape = tuple(
+        1 if n == 1 else math.ceil(n * old / new)  # keep singleton dimensions
+        for n, old, new in zip(shape, old_spacing, spacing)
+    )
+    new_origin_index = 0.5 * (np.array(spacing) / old_spacing - 1)
+    new_affine = np.eye(4)
+    new_affine[:3, :3] = rotation * spacing
+    new_affine[:3, 3] = affine[:3, :3] @ new_origin_index + affine[:3, 3]
+    return new_affine, new_shape
+
+
+def _get_sampling_grid(
+        src_affine: np.ndarray,
+        src_shape: TypeTripletInt,
+        dst_affine: np.ndarray,
+        dst_shape: TypeTripletInt,
+        device: torch.device,
+        ) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Return the grid used by ``grid_sample`` and a mask of the points
+    inside the field of view of the source."""
+    # Voxel indices in the target to voxel indices in the source
+    voxel_to_voxel = np.linalg.inv(src_affine) @ dst_affine
+    # grid_sample uses coordinates in [-1, 1] in (D, H, W) order, i.e.,
+    # reversed with respect to the (W, H, D) order used in TorchIO
+    reverse = np.eye(4)[[2, 1, 0, 3]]
+    theta = (
+        reverse
+        @ _get_normalization_matrix(src_shape)
+        @ voxel_to_voxel
+        @ np.linalg.inv(_get_normalization_matrix(dst_shape))
+        @ reverse
+    )
+    theta = torch.as_tensor(
+        theta[np.newaxis, :3],
+        dtype=torch.float32,
+        device=device,
+    )
+    size = 1, 1, *dst_shape
+    grid = F.affine_grid(theta, size, align_corners=False)
+    inside = ((grid >= -1) & (grid < 1)).all(dim=-1)
+    return grid, inside
+
+
+def _resample_torch(
+        data: torch.Tensor,
+        grid: torch.Tensor,
+        inside: torch.Tensor,
+        mode: str,
+        ) -> torch.Tensor:
+    """Resample a 4D tensor onto a new grid using ``grid_sample``."""
+    resampled = F.grid_sample(
+        data[np.newaxis],
+        grid,
+        mode=mode,
+        padding_mode='border',
+        align_corners=False,
+    )
+    # Like ITK, use the border values only inside the field of view
+    resampled *= inside[:, np.newaxis]
+    return resampled[0]
+
+
+def _get_normalization_matrix(shape: Sequence[int]) -> np.ndarray:
+    """Map voxel indices to the normalized coordinates of ``grid_sample``."""
+    shape = np.array(shape, dtype=float)
+    matrix = np.eye(4)
+    matrix[:3, :3] = np.diag(2 / shape)
+    matrix[:3, 3] = 1 / shape - 1
+    return matrix